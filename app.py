@@ -1,6 +1,18 @@
 import streamlit as st
 import pandas as pd
 import io
+import os
+import copy
+import datetime
+import functools
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
+from contextlib import contextmanager
 
 # ==========================================
 # 1. 基础配置
@@ -99,19 +111,11 @@ st.markdown("""
 # ==========================================
 # 2. 数据清洗与辅助函数
 # ==========================================
-def clean_number(x):
-    if isinstance(x, pd.Series): x = x.iloc[0]
-    if pd.isna(x): return 0
-    s = str(x).strip().replace(',', '').replace(' ', '')
-    try: return float(s)
-    except: return 0
-
 def to_int(x):
     try: return int(round(float(x)))
     except: return 0
 
 def normalize_str(s):
-    if isinstance(s, pd.Series): s = s.iloc[0]
     if pd.isna(s): return ""
     return str(s).strip().upper()
 
@@ -122,9 +126,53 @@ def normalize_wh_name(name):
     if "云" in n or "天源" in n: return "云仓"
     return "其他"
 
-def is_walmart_country(country):
-    c = normalize_str(country)
-    return "沃尔玛" in c or "WALMART" in c
+# --- 整列向量化清洗 ---
+WH_BLACKLIST = ["沃尔玛", "WALMART", "TEMU"]
+
+@functools.lru_cache(maxsize=None)
+def classify_wh_name(name):
+    """单个仓库名 -> (仓库类型, 是否黑名单)，按去重后的仓库名缓存"""
+    n = normalize_str(name)
+    return normalize_wh_name(n), any(k in n for k in WH_BLACKLIST)
+
+def _parse_float(v):
+    try: return float(v)
+    except: return float('nan')
+
+def clean_number_col(s):
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        return s.astype(float).fillna(0)
+    txt = s.astype(str).str.strip().str.replace(',', '', regex=False).str.replace(' ', '', regex=False)
+    num = pd.to_numeric(txt, errors='coerce').astype(float)
+    # to_numeric 不认全角数字、下划线分隔等 float() 能解析的写法，未解析的去重值回落到 float() 逐个判定
+    miss = num.isna() & s.notna()
+    if miss.any():
+        lookup = {v: _parse_float(v) for v in txt[miss].unique()}
+        num = num.where(~miss, txt.map(lookup))
+    return num.fillna(0).where(s.notna(), 0)
+
+def normalize_str_col(s):
+    return s.astype(str).where(s.notna(), '').str.strip().str.upper()
+
+def is_walmart_col(s):
+    c = normalize_str_col(s)
+    return c.str.contains("沃尔玛", regex=False) | c.str.contains("WALMART", regex=False)
+
+def build_clean_frame(df, c_sku, c_fnsku, c_qty, c_wh=None, c_zone=None):
+    """整表清洗为 sku/fnsku/qty(/wh_raw/wh_type/blacklisted/zone)，供建池逐条装入字典"""
+    out = pd.DataFrame(index=df.index)
+    out['sku'] = normalize_str_col(df[c_sku])
+    out['fnsku'] = normalize_str_col(df[c_fnsku]) if c_fnsku else ""
+    out['qty'] = clean_number_col(df[c_qty])
+    if c_wh:
+        wh_raw = df[c_wh].astype(str)
+        # 每个去重后的仓库名只判定一次，再按名称回填整列
+        lookup = {name: classify_wh_name(name) for name in wh_raw.unique()}
+        out['wh_raw'] = wh_raw
+        out['wh_type'] = wh_raw.map({k: v[0] for k, v in lookup.items()})
+        out['blacklisted'] = wh_raw.map({k: v[1] for k, v in lookup.items()}).astype(bool)
+        out['zone'] = df[c_zone].astype(str).str.strip() if c_zone else "-"
+    return out
 
 def load_and_find_header(file):
     if not file: return None, "未上传"
@@ -171,6 +219,9 @@ def load_and_find_header(file):
     except Exception as e:
         return None, f"读取错误: {str(e)}"
 
+class InputLoadError(Exception):
+    pass
+
 # ==========================================
 # 3. 核心：库存管理器
 # ==========================================
@@ -189,6 +240,15 @@ class InventoryManager:
         self._deduct_plan_from_po()
         self._merge_inbound_for_allocation()
 
+    def fork(self):
+        """工作副本：与原始池共享数据，按 SKU 首次访问时才复制，扣减永远不会写回原始池"""
+        wc = object.__new__(type(self))
+        wc.stock = CowPool(self.stock)
+        wc.inbound = CowPool(self.inbound)
+        wc.po, wc.plan = self.po, self.plan
+        wc.cleaning_logs = list(self.cleaning_logs)
+        return wc
+
     def _match_col(self, df, keywords):
         for k in keywords:
             for col in df.columns:
@@ -207,23 +267,15 @@ class InventoryManager:
 
         if not (c_sku and c_wh and c_qty): return
 
-        for idx, row in df.iterrows():
-            w_name_raw = str(row.get(c_wh, ''))
-            w_name_norm = normalize_str(w_name_raw)
-            sku = str(row.get(c_sku, '')).strip().upper() 
-            
-            if any(k in w_name_norm for k in ["沃尔玛", "WALMART", "TEMU"]): 
+        cf = build_clean_frame(df, c_sku, c_fnsku, c_qty, c_wh=c_wh, c_zone=c_zone)
+        for sku, fnsku, qty, w_name_raw, w_type, black, zone in zip(
+                cf['sku'], cf['fnsku'], cf['qty'], cf['wh_raw'], cf['wh_type'], cf['blacklisted'], cf['zone']):
+            if black:
                 self.cleaning_logs.append({"类型": "库存过滤", "SKU": sku, "原因": f"剔除黑名单仓库 ({w_name_raw})"})
                 continue
             if not sku: continue
-            
-            f_raw = row.get(c_fnsku, '')
-            fnsku = str(f_raw).strip().upper() if pd.notna(f_raw) else ""
-            qty = clean_number(row.get(c_qty, 0))
-            zone = str(row.get(c_zone, '')).strip() if c_zone else "-"
             if qty <= 0: continue
-            
-            w_type = normalize_wh_name(w_name_raw)
+
             if sku not in self.stock: self.stock[sku] = {}
             if fnsku not in self.stock[sku]: self.stock[sku][fnsku] = {'深仓':[], '外协':[], '云仓':[], '采购订单':[], '其他':[]}
             self.stock[sku][fnsku][w_type].append({'qty': qty, 'raw_name': w_name_raw, 'zone': zone})
@@ -235,12 +287,8 @@ class InventoryManager:
         c_qty = self._match_col(df, ['未入库', '未交', '在途', '数量', 'QTY', '需求'])
         if not c_sku or not c_qty: return
 
-        for idx, row in df.iterrows():
-            sku = str(row.get(c_sku, '')).strip().upper()
-                    
-            qty = clean_number(row.get(c_qty, 0))
-            f_raw = row.get(c_fnsku, '')
-            fnsku = str(f_raw).strip().upper() if pd.notna(f_raw) else ""
+        cf = build_clean_frame(df, c_sku, c_fnsku, c_qty)
+        for sku, fnsku, qty in zip(cf['sku'], cf['fnsku'], cf['qty']):
             if sku and qty > 0:
                 if sku not in self.po: self.po[sku] = {}
                 if fnsku not in self.po[sku]: self.po[sku][fnsku] = []
@@ -253,11 +301,8 @@ class InventoryManager:
         c_qty = self._match_col(df, ['数量', 'QTY', '需求'])
         
         if not c_sku or not c_qty: return
-        for idx, row in df.iterrows():
-            sku = str(row.get(c_sku, '')).strip().upper() 
-            qty = clean_number(row.get(c_qty, 0))
-            f_raw = row.get(c_fnsku, '')
-            fnsku = str(f_raw).strip().upper() if pd.notna(f_raw) else ""
+        cf = build_clean_frame(df, c_sku, c_fnsku, c_qty)
+        for sku, fnsku, qty in zip(cf['sku'], cf['fnsku'], cf['qty']):
             if sku and qty > 0:
                 if sku not in self.plan: self.plan[sku] = {}
                 if fnsku not in self.plan[sku]: self.plan[sku][fnsku] = []
@@ -427,10 +472,87 @@ class InventoryManager:
 
         return qty_remain, usage_breakdown, process_details, deduction_log, entity_usage
 
+# --- 跨会话共享库存池 ---
+class CowPool(Mapping):
+    """按 SKU 写时复制的资源池视图：首次取某 SKU 时深拷贝其子树，之后的扣减只落在副本上"""
+    def __init__(self, base):
+        self._base = base
+        self._own = {}
+
+    def __getitem__(self, sku):
+        if sku not in self._own:
+            self._own[sku] = copy.deepcopy(self._base[sku])
+        return self._own[sku]
+
+    def __contains__(self, sku): return sku in self._base
+    def __iter__(self): return iter(self._base)
+    def __len__(self): return len(self._base)
+
+def input_fingerprint(*files):
+    h = hashlib.sha256()
+    for f in files:
+        if f is None:
+            h.update(b"-|")
+            continue
+        h.update(str(getattr(f, 'name', '')).encode('utf-8') + b"|")
+        h.update(hashlib.sha256(f.getvalue()).digest())
+    return h.hexdigest()
+
+class SharedInventoryStore:
+    """进程级共享库存：同一组输入只建一次净化后的原始池，各会话 checkout 写时复制的工作副本"""
+    def __init__(self, max_entries=4, ttl_seconds=12 * 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    @contextmanager
+    def checkout(self, key, build):
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {'mgr': None, 'refs': 0, 'last_used': time.time(), 'build_lock': threading.Lock()}
+                self._entries[key] = entry
+            entry['refs'] += 1
+        try:
+            # 同一输入并发到达时只有一个会话真正建池，其余等待复用
+            with entry['build_lock']:
+                if entry['mgr'] is None: entry['mgr'] = build()
+            yield entry['mgr'].fork()
+        finally:
+            with self._lock:
+                entry['refs'] -= 1
+                entry['last_used'] = time.time()
+                # 建池失败时，仍有会话在等 build_lock 的条目要保留，由它们接着重建
+                if entry['mgr'] is None and entry['refs'] == 0 and self._entries.get(key) is entry: del self._entries[key]
+                self._evict()
+
+    def invalidate(self, key=None):
+        """新导出到达时显式失效；正在使用旧池的会话持有各自副本，不受影响"""
+        with self._lock:
+            if key is None: self._entries.clear()
+            else: self._entries.pop(key, None)
+
+    def _evict(self):
+        now = time.time()
+        for k in [k for k, e in self._entries.items() if e['refs'] == 0 and now - e['last_used'] > self.ttl_seconds]:
+            del self._entries[k]
+        idle = sorted((e['last_used'], k) for k, e in self._entries.items() if e['refs'] == 0)
+        while len(self._entries) > self.max_entries and idle:
+            del self._entries[idle.pop(0)[1]]
+
+    def stats(self):
+        with self._lock:
+            self._evict()
+            return [{"输入指纹": k[:12], "已建池": e['mgr'] is not None, "使用中会话": e['refs'],
+                     "最近使用": time.strftime('%H:%M:%S', time.localtime(e['last_used']))} for k, e in self._entries.items()]
+
 # ==========================================
 # 4. 主逻辑流程 (分配引擎)
 # ==========================================
-def run_allocation(df_input, inv_mgr, mapping):
+def prepare_demand(df_input, mapping):
+    """需求表整列归一化 -> (SKU 汇总需求, 有效需求行)；会原地改写 df_input 的 SKU/FNSKU 列"""
     col_sku = mapping['SKU']
     col_qty = mapping['数量']
     col_tag = mapping['标签']
@@ -440,13 +562,26 @@ def run_allocation(df_input, inv_mgr, mapping):
     # 防止 Pandas 空值引发字符串不匹配
     df_input.fillna('', inplace=True)
     
-    for idx in df_input.index:
-        df_input.at[idx, col_sku] = str(df_input.at[idx, col_sku]).strip().upper()
-        df_input.at[idx, col_fnsku] = str(df_input.at[idx, col_fnsku]).strip().upper()
+    # 整列归一化，SKU/FNSKU 存为 category，后续分组按整数编码进行
+    df_input[col_sku] = normalize_str_col(df_input[col_sku]).astype('category')
+    df_input[col_fnsku] = normalize_str_col(df_input[col_fnsku]).astype('category')
 
-    df_input['__clean_qty'] = df_input[col_qty].apply(clean_number)
-    demand_summary = df_input.groupby(col_sku)['__clean_qty'].sum().to_dict()
-    df_input.drop(columns=['__clean_qty'], inplace=True)
+    qty_col = clean_number_col(df_input[col_qty])
+    demand_summary = qty_col.groupby(df_input[col_sku], observed=True).sum().to_dict()
+
+    country_col = df_input[col_country].astype(str).str.strip()
+    is_us_col = country_col.str.upper().str.contains('US', regex=False) | country_col.str.contains('美国', regex=False)
+    walmart_col = is_walmart_col(country_col)
+    valid = (qty_col > 0) & (df_input[col_sku].astype(str) != '')
+    
+    demand_rows = list(zip(
+        df_input.index[valid], df_input.loc[valid, col_tag].astype(str).str.strip(), country_col[valid],
+        df_input.loc[valid, col_sku].astype(str), df_input.loc[valid, col_fnsku].astype(str),
+        qty_col[valid], is_us_col[valid], walmart_col[valid]))
+    return demand_summary, demand_rows
+
+def run_allocation(df_input, inv_mgr, mapping, prepare=prepare_demand):
+    demand_summary, demand_rows = prepare(df_input, mapping)
     
     order_list = []
     for sku, req_qty in demand_summary.items():
@@ -469,19 +604,10 @@ def run_allocation(df_input, inv_mgr, mapping):
     tasks = []
     calc_logs = []
     
-    for idx, row in df_input.iterrows():
-        tag = str(row.get(col_tag, '')).strip()
-        country = str(row.get(col_country, '')).strip()
-        sku = str(row.get(col_sku, '')).strip()
-        fnsku = str(row.get(col_fnsku, '')).strip()
-        qty = clean_number(row.get(col_qty, 0))
-        
-        if qty <= 0 or not sku: continue
-        is_us = 'US' in country.upper() or '美国' in country
-            
+    for idx, tag, country, sku, fnsku, qty, is_us, is_walmart in demand_rows:
         tasks.append({
             'row_idx': idx, 'sku': sku, 'fnsku': fnsku, 'qty': qty,
-            'country': country, 'is_us': is_us, 'is_walmart': is_walmart_country(country), 'tag': tag,
+            'country': country, 'is_us': bool(is_us), 'is_walmart': bool(is_walmart), 'tag': tag,
             'filled': 0, 'usage': {}, 'entity_usage': {}, 'proc': {'raw_wh': [], 'zone': [], 'fnsku': [], 'qty': 0}, 'logs': []
         })
 
@@ -644,8 +770,361 @@ def run_allocation(df_input, inv_mgr, mapping):
     return pd.DataFrame(output_rows), calc_logs, inv_mgr.cleaning_logs, df_order_advice
 
 # ==========================================
-# 5. UI 渲染
+# 5. 影子模式：新旧引擎差分校验
+# ==========================================
+# 引擎统一签名：engine(df_input, df_inv, df_po, df_plan, mapping)
+#   -> (分配结果, 运算日志, 清洗日志, 待下单清单, 剩余资源池快照)
+def pool_snapshot(inv_mgr):
+    rows = []
+    for pool_name, pool in [('stock', inv_mgr.stock), ('inbound', inv_mgr.inbound)]:
+        for sku, f_dict in pool.items():
+            for fnsku, v in f_dict.items():
+                items = [(w, i) for w, lst in v.items() for i in lst] if pool_name == 'stock' else [(i['raw_name'], i) for i in v]
+                for w, i in items:
+                    rows.append({"SKU": sku, "FNSKU": fnsku, "资源池": w, "来源": i['raw_name'], "库位": i['zone'], "剩余数量": i['qty']})
+    df = pd.DataFrame(rows, columns=["SKU", "FNSKU", "资源池", "来源", "库位", "剩余数量"])
+    return df.groupby(["SKU", "FNSKU", "资源池", "来源", "库位"], as_index=False)["剩余数量"].sum()
+
+# --- V36.1 逐行清洗基准：向量化清洗之前的原始实现，仅作影子模式的对照基准 ---
+def _rowwise_number(x):
+    if pd.isna(x): return 0
+    s = str(x).strip().replace(',', '').replace(' ', '')
+    try: return float(s)
+    except: return 0
+
+class RowwiseInventoryManager(InventoryManager):
+    def _init_inventory(self, df):
+        if df is None or df.empty: return
+        c_sku = self._match_col(df, ['SKU', '编码', '代码', '型号'])
+        c_fnsku = self._match_col(df, ['FNSKU', '条码', '标签', '贴标要求'])
+        c_wh = self._match_col(df, ['仓库'])
+        c_zone = self._match_col(df, ['库位', '库区', 'ZONE'])
+        c_qty = self._match_col(df, ['可用', '数量', '库存'])
+
+        if not (c_sku and c_wh and c_qty): return
+
+        for idx, row in df.iterrows():
+            w_name_raw = str(row.get(c_wh, ''))
+            w_name_norm = normalize_str(w_name_raw)
+            sku = str(row.get(c_sku, '')).strip().upper() 
+            
+            if any(k in w_name_norm for k in WH_BLACKLIST): 
+                self.cleaning_logs.append({"类型": "库存过滤", "SKU": sku, "原因": f"剔除黑名单仓库 ({w_name_raw})"})
+                continue
+            if not sku: continue
+            
+            f_raw = row.get(c_fnsku, '')
+            fnsku = str(f_raw).strip().upper() if pd.notna(f_raw) else ""
+            qty = _rowwise_number(row.get(c_qty, 0))
+            zone = str(row.get(c_zone, '')).strip() if c_zone else "-"
+            if qty <= 0: continue
+            
+            w_type = normalize_wh_name(w_name_raw)
+            if sku not in self.stock: self.stock[sku] = {}
+            if fnsku not in self.stock[sku]: self.stock[sku][fnsku] = {'深仓':[], '外协':[], '云仓':[], '采购订单':[], '其他':[]}
+            self.stock[sku][fnsku][w_type].append({'qty': qty, 'raw_name': w_name_raw, 'zone': zone})
+
+    def _init_po(self, df):
+        if df is None or df.empty: return
+        c_sku = self._match_col(df, ['SKU', '编码', '代码', '型号'])
+        c_fnsku = self._match_col(df, ['FNSKU', '贴标要求', '条码', '标签'])
+        c_qty = self._match_col(df, ['未入库', '未交', '在途', '数量', 'QTY', '需求'])
+        if not c_sku or not c_qty: return
+
+        for idx, row in df.iterrows():
+            sku = str(row.get(c_sku, '')).strip().upper()
+            qty = _rowwise_number(row.get(c_qty, 0))
+            f_raw = row.get(c_fnsku, '')
+            fnsku = str(f_raw).strip().upper() if pd.notna(f_raw) else ""
+            if sku and qty > 0:
+                if sku not in self.po: self.po[sku] = {}
+                if fnsku not in self.po[sku]: self.po[sku][fnsku] = []
+                self.po[sku][fnsku].append({'qty': qty, 'raw_name': '采购订单', 'zone': '-'})
+
+    def _init_plan(self, df):
+        if df is None or df.empty: return
+        c_sku = self._match_col(df, ['SKU', '编码', '代码', '型号'])
+        c_fnsku = self._match_col(df, ['FNSKU', '贴标要求', '条码', '标签'])
+        c_qty = self._match_col(df, ['数量', 'QTY', '需求'])
+        
+        if not c_sku or not c_qty: return
+        for idx, row in df.iterrows():
+            sku = str(row.get(c_sku, '')).strip().upper() 
+            qty = _rowwise_number(row.get(c_qty, 0))
+            f_raw = row.get(c_fnsku, '')
+            fnsku = str(f_raw).strip().upper() if pd.notna(f_raw) else ""
+            if sku and qty > 0:
+                if sku not in self.plan: self.plan[sku] = {}
+                if fnsku not in self.plan[sku]: self.plan[sku][fnsku] = []
+                self.plan[sku][fnsku].append({'qty': qty, 'raw_name': '提货计划', 'zone': '-'})
+
+def prepare_demand_rowwise(df_input, mapping):
+    col_sku = mapping['SKU']
+    col_qty = mapping['数量']
+    col_tag = mapping['标签']
+    col_country = mapping['国家']
+    col_fnsku = mapping['FNSKU']
+
+    df_input.fillna('', inplace=True)
+    for idx in df_input.index:
+        df_input.at[idx, col_sku] = str(df_input.at[idx, col_sku]).strip().upper()
+        df_input.at[idx, col_fnsku] = str(df_input.at[idx, col_fnsku]).strip().upper()
+
+    df_input['__clean_qty'] = df_input[col_qty].apply(_rowwise_number)
+    demand_summary = df_input.groupby(col_sku)['__clean_qty'].sum().to_dict()
+    df_input.drop(columns=['__clean_qty'], inplace=True)
+
+    demand_rows = []
+    for idx, row in df_input.iterrows():
+        tag = str(row.get(col_tag, '')).strip()
+        country = str(row.get(col_country, '')).strip()
+        sku = str(row.get(col_sku, '')).strip()
+        fnsku = str(row.get(col_fnsku, '')).strip()
+        qty = _rowwise_number(row.get(col_qty, 0))
+        if qty <= 0 or not sku: continue
+        c = normalize_str(country)
+        demand_rows.append((idx, tag, country, sku, fnsku, qty,
+                            'US' in country.upper() or '美国' in country, "沃尔玛" in c or "WALMART" in c))
+    return demand_summary, demand_rows
+
+def reference_engine(df_input, df_inv, df_po, df_plan, mapping):
+    mgr = RowwiseInventoryManager(df_inv, df_po, df_plan)
+    final_df, logs, cleans, order_advice = run_allocation(df_input, mgr, mapping, prepare=prepare_demand_rowwise)
+    return final_df, logs, cleans, order_advice, pool_snapshot(mgr)
+
+def vectorized_engine(df_input, df_inv, df_po, df_plan, mapping):
+    mgr = InventoryManager(df_inv, df_po, df_plan)
+    final_df, logs, cleans, order_advice = run_allocation(df_input, mgr, mapping)
+    return final_df, logs, cleans, order_advice, pool_snapshot(mgr)
+
+def make_shared_store_engine(store, key):
+    """候选引擎：走 store.checkout 的生产路径（引用计数、淘汰、写时复制副本），只计一次 checkout 的耗时。
+    附带 recheck：在计时之外再 checkout 一次，结果若与第一次不同，说明原始池被会话扣减污染"""
+    def engine(df_input, df_inv, df_po, df_plan, mapping):
+        with store.checkout(key, lambda: InventoryManager(df_inv, df_po, df_plan)) as mgr:
+            final_df, logs, cleans, order_advice = run_allocation(df_input, mgr, mapping)
+            return final_df, logs, cleans, order_advice, pool_snapshot(mgr)
+
+    def recheck(df_input, df_inv, df_po, df_plan, mapping, final_df):
+        with store.checkout(key, lambda: InventoryManager(df_inv, df_po, df_plan)) as mgr:
+            again, _, _, _ = run_allocation(df_input, mgr, mapping)
+        return final_df.equals(again)
+
+    engine.recheck = recheck
+    return engine
+
+# 影子对比的引擎；基准固定为逐行清洗的 V36.1 原始实现，选择基准本身即为确定性自检
+ALLOCATION_ENGINES = {"V36.1 基准引擎(逐行清洗)": reference_engine, "向量化清洗引擎(生产)": vectorized_engine}
+# 共享库存池候选依赖具体的池与输入指纹，执行时由 make_shared_store_engine 现场构造
+SHARED_STORE_ENGINE = "共享库存池(生产 checkout)"
+
+def _first_divergence(name, ref, cand):
+    ref = ref.reset_index(drop=True)
+    cand = cand.reset_index(drop=True)
+    if list(ref.columns) != list(cand.columns):
+        return {"对象": name, "行": "-", "列": "(列结构)", "基准值": list(ref.columns), "影子值": list(cand.columns)}
+    n = min(len(ref), len(cand))
+    diff = (ref.head(n).astype(str).to_numpy() != cand.head(n).astype(str).to_numpy()).nonzero()
+    if len(diff[0]):
+        i, j = diff[0][0], diff[1][0]
+        return {"对象": name, "行": int(i) + 1, "列": ref.columns[j], "基准值": ref.iat[i, j], "影子值": cand.iat[i, j]}
+    if len(ref) != len(cand):
+        return {"对象": name, "行": n + 1, "列": "(行数)", "基准值": len(ref), "影子值": len(cand)}
+    return None
+
+def run_shadow(df_input, df_inv, df_po, df_plan, mapping, candidate, reference=reference_engine):
+    """同一输入分别跑基准引擎与候选引擎，逐行比对；对外只采用基准结果"""
+    t0 = time.perf_counter()
+    ref_out = reference(df_input.copy(), df_inv, df_po, df_plan, mapping)
+    ref_secs = time.perf_counter() - t0
+
+    report = {"一致": False, "首个差异": None, "基准耗时(s)": round(ref_secs, 4), "影子耗时(s)": None, "影子异常": None, "原始池复检": None}
+    try:
+        t0 = time.perf_counter()
+        cand_out = candidate(df_input.copy(), df_inv, df_po, df_plan, mapping)
+        report["影子耗时(s)"] = round(time.perf_counter() - t0, 4)
+    except Exception as e:
+        report["影子异常"] = f"{type(e).__name__}: {e}"
+        return ref_out, report
+
+    # 候选引擎自带的附加检查（如共享池复检）放在计时之外，不计入影子耗时
+    recheck = getattr(candidate, 'recheck', None)
+    if recheck:
+        try:
+            ok = recheck(df_input.copy(), df_inv, df_po, df_plan, mapping, cand_out[0])
+            report["原始池复检"] = "通过" if ok else "不一致：共享原始池被会话扣减改写"
+        except Exception as e:
+            report["原始池复检"] = f"{type(e).__name__}: {e}"
+
+    checks = [("分配结果", 0), ("剩余资源池", 4), ("待下单清单", 3)]
+    for name, k in checks:
+        div = _first_divergence(name, ref_out[k], cand_out[k])
+        if div:
+            report["首个差异"] = div
+            return ref_out, report
+    report["一致"] = report["原始池复检"] in (None, "通过")
+    return ref_out, report
+
+def make_synthetic_case(seed=0, n_sku=30, n_rows=200):
+    """合成一组覆盖 US/沃尔玛/裸货/黑名单仓/提货计划冲 PO 的测试输入"""
+    rnd = random.Random(seed)
+    skus = [f"SKU{i:03d}" for i in range(n_sku)]
+    fnskus = ["", "X001A", "X001B", "X001C"]
+    whs = ["深圳仓", "外协仓A", "云仓", "天源仓", "沃尔玛仓", "TEMU仓", "海外仓"]
+    countries = ["US", "美国", "CA", "UK", "沃尔玛", "Walmart-US"]
+
+    def qty(lo, hi):
+        q, r = rnd.randint(lo, hi), rnd.random()
+        if r < 0.15: return f"{q:,}"
+        if r < 0.25: return str(q).translate(str.maketrans("0123456789", "０１２３４５６７８９"))  # 中文输入法下的全角数字
+        return q
+
+    df_inv = pd.DataFrame([{"SKU": rnd.choice(skus).lower(), "FNSKU": rnd.choice(fnskus), "仓库": rnd.choice(whs),
+                            "库位": f"Z{rnd.randint(1, 9)}", "可用数量": qty(0, 800)} for _ in range(n_rows)])
+    df_po = pd.DataFrame([{"SKU": rnd.choice(skus), "FNSKU": rnd.choice(fnskus), "未入库数量": qty(0, 1500)} for _ in range(n_rows // 2)])
+    df_plan = pd.DataFrame([{"SKU": rnd.choice(skus), "FNSKU": rnd.choice(fnskus), "数量": qty(0, 400)} for _ in range(n_rows // 4)])
+    df_input = pd.DataFrame([{"标签": rnd.choice(["", "新品", "常规"]), "国家": rnd.choice(countries), "SKU": rnd.choice(skus),
+                              "FNSKU": rnd.choice(fnskus), "数量": qty(1, 1200), "运营": "", "店铺": "", "备注": ""} for _ in range(n_rows)])
+    mapping = {'标签': '标签', '国家': '国家', 'SKU': 'SKU', 'FNSKU': 'FNSKU', '数量': '数量'}
+    return df_input, df_inv, df_po, df_plan, mapping
+
+# ==========================================
+# 6. 运行历史：本地 SQLite 索引
+# ==========================================
+RUN_HISTORY_DB = os.environ.get("RUN_HISTORY_DB", "run_history.db")
+
+RUN_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    fingerprints TEXT NOT NULL,
+    n_rows INTEGER, n_short_sku INTEGER,
+    report BLOB
+);
+CREATE TABLE IF NOT EXISTS run_frames (
+    run_id INTEGER NOT NULL, kind TEXT NOT NULL, data TEXT NOT NULL,
+    PRIMARY KEY (run_id, kind)
+);
+CREATE TABLE IF NOT EXISTS allocations (
+    run_id INTEGER NOT NULL, row_no INTEGER NOT NULL,
+    sku TEXT, fnsku TEXT, country TEXT, tag TEXT,
+    demand_qty REAL, filled_qty REAL, status TEXT, shortage TEXT, entity TEXT,
+    PRIMARY KEY (run_id, row_no)
+);
+DROP INDEX IF EXISTS idx_alloc_fnsku;
+DROP INDEX IF EXISTS idx_alloc_country;
+CREATE INDEX IF NOT EXISTS idx_alloc_sku ON allocations (sku, run_id);
+CREATE INDEX IF NOT EXISTS idx_alloc_sku_country ON allocations (sku, country, run_id);
+CREATE INDEX IF NOT EXISTS idx_alloc_sku_fnsku ON allocations (sku, fnsku, run_id);
+CREATE INDEX IF NOT EXISTS idx_runs_created ON runs (created_at);
+"""
+
+def build_report_xlsx(final_df, logs, cleans, order_advice):
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine='xlsxwriter') as writer:
+        final_df.to_excel(writer, sheet_name='分配结果', index=False)
+        if not order_advice.empty: order_advice.to_excel(writer, sheet_name='待下单清单(已去重)', index=False)
+        pd.DataFrame(logs).to_excel(writer, sheet_name='运算日志', index=False)
+        pd.DataFrame(cleans).to_excel(writer, sheet_name='清洗去重日志', index=False)
+    return buf.getvalue()
+
+def demand_fingerprint(df):
+    return hashlib.sha256(df.to_csv(index=False).encode('utf-8')).hexdigest()
+
+class RunHistory:
+    """每次运算的结果落盘：按运行、SKU、FNSKU、国家建索引，历史报告直接取已存的 xlsx，无需重算"""
+    def __init__(self, path=RUN_HISTORY_DB):
+        self.path = path
+        with self._connect() as conn:
+            conn.executescript(RUN_HISTORY_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def save_run(self, final_df, logs, cleans, order_advice, mapping, fingerprints, report=None):
+        def col(name, default=''):
+            if name in final_df.columns: return final_df[name]
+            return pd.Series(default, index=final_df.index)
+
+        n = len(final_df)
+        n_short = int(order_advice['SKU'].nunique()) if not order_advice.empty else 0
+        frames = {"分配结果": final_df, "运算日志": pd.DataFrame(logs), "清洗去重日志": pd.DataFrame(cleans), "待下单清单": order_advice}
+        with self._connect() as conn:
+            cur = conn.execute("INSERT INTO runs (created_at, fingerprints, n_rows, n_short_sku, report) VALUES (?, ?, ?, ?, ?)",
+                               (time.strftime('%Y-%m-%d %H:%M:%S'), json.dumps(fingerprints), n, n_short, report))
+            run_id = cur.lastrowid
+            conn.executemany("INSERT INTO run_frames (run_id, kind, data) VALUES (?, ?, ?)",
+                             [(run_id, k, df.to_json(orient='split', force_ascii=False)) for k, df in frames.items()])
+            conn.executemany("INSERT INTO allocations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", zip(
+                [run_id] * n, range(1, n + 1),
+                normalize_str_col(col(mapping['SKU'])).tolist(), normalize_str_col(col(mapping['FNSKU'])).tolist(),
+                normalize_str_col(col(mapping['国家'])).tolist(), col(mapping['标签']).astype(str).str.strip().tolist(),
+                clean_number_col(col(mapping['数量'], 0)).tolist(), clean_number_col(col('最终发货数量', 0)).tolist(),
+                col('库存状态').astype(str).tolist(), col('缺货与否').astype(str).tolist(), col('发货主体').astype(str).tolist()))
+        return run_id
+
+    @staticmethod
+    def _date_filter(column, date_from, date_to):
+        """created_at 为 'YYYY-MM-DD HH:MM:SS' 文本，按字典序即可走索引做日期区间过滤（含 date_to 当天）"""
+        sql, params = "", []
+        if date_from:
+            sql += f" AND {column} >= ?"; params.append(str(date_from))
+        if date_to:
+            sql += f" AND {column} < ?"; params.append(str(date_to + datetime.timedelta(days=1)))
+        return sql, params
+
+    def find_runs(self, date_from=None, date_to=None, limit=50):
+        where, params = self._date_filter("created_at", date_from, date_to)
+        with self._connect() as conn:
+            return pd.read_sql_query("SELECT run_id AS 运行号, created_at AS 运行时间, n_rows AS 需求行数, n_short_sku AS 缺货SKU数 "
+                                     f"FROM runs WHERE 1 = 1{where} ORDER BY run_id DESC LIMIT ?", conn, params=params + [limit])
+
+    def load_report(self, run_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT report FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        return row[0] if row else None
+
+    def load_frames(self, run_id):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT kind, data FROM run_frames WHERE run_id = ?", (run_id,)).fetchall()
+        return {k: pd.read_json(io.StringIO(d), orient='split', dtype=False, convert_dates=False) for k, d in rows}
+
+    def sku_history(self, sku, fnsku=None, country=None, date_from=None, date_to=None, limit=200):
+        sql = ("SELECT a.run_id AS 运行号, r.created_at AS 运行时间, a.sku AS SKU, a.fnsku AS FNSKU, a.country AS 国家, "
+               "a.tag AS 标签, a.demand_qty AS 需求数, a.filled_qty AS 最终发货数量, a.status AS 库存状态, "
+               "a.shortage AS 缺货与否, a.entity AS 发货主体 "
+               "FROM allocations a JOIN runs r ON r.run_id = a.run_id WHERE a.sku = ?")
+        params = [normalize_str(sku)]
+        if fnsku is not None:
+            sql += " AND a.fnsku = ?"; params.append(normalize_str(fnsku))
+        if country:
+            sql += " AND a.country = ?"; params.append(normalize_str(country))
+        where, date_params = self._date_filter("r.created_at", date_from, date_to)
+        sql += where
+        params += date_params
+        sql += " ORDER BY a.run_id DESC, a.row_no LIMIT ?"
+        params.append(limit)
+        with self._connect() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+
+# ==========================================
+# 7. UI 渲染
 # ==========================================
+@st.cache_resource
+def get_inventory_store():
+    return SharedInventoryStore()
+
+@st.cache_resource
+def get_run_history():
+    return RunHistory()
+
 if 'df_demand' not in st.session_state:
     st.session_state.df_demand = pd.DataFrame(columns=["标签", "国家", "SKU", "FNSKU", "数量", "运营", "店铺", "备注"])
 
@@ -692,6 +1171,70 @@ with col_side:
     run_btn = st.button("🚀  执行全局智能分配", type="primary", use_container_width=True)
     st.markdown('</div>', unsafe_allow_html=True)
 
+    # --- 影子模式（差分校验） ---
+    def render_shadow_report(report):
+        timing = f"基准 {report['基准耗时(s)']}s / 影子 {report['影子耗时(s)'] if report['影子耗时(s)'] is not None else '-'}s"
+        if report['影子异常']: st.error(f"🧪 影子引擎运行异常（{timing}）：{report['影子异常']}")
+        elif report['一致']: st.success(f"🧪 影子校验一致（{timing}）" + ("，原始池复检通过" if report['原始池复检'] else ""))
+        elif report['首个差异'] is None: st.error(f"🧪 原始池复检失败（{timing}）：{report['原始池复检']}")
+        else:
+            recheck_note = f"；原始池复检：{report['原始池复检']}" if report['原始池复检'] not in (None, "通过") else ""
+            st.error(f"🧪 影子校验发现差异（{timing}）{recheck_note}")
+            st.dataframe(pd.DataFrame([{k: str(v) for k, v in report['首个差异'].items()}]), use_container_width=True)
+
+    with st.expander("🧪 影子模式校验"):
+        shadow_on = st.checkbox("执行时同时运行影子引擎并比对（输出仍以基准引擎为准）")
+        shadow_engine = st.selectbox("影子引擎", list(ALLOCATION_ENGINES.keys()) + [SHARED_STORE_ENGINE], index=1)
+        if st.button("用合成数据自检", use_container_width=True):
+            with st.spinner("⚙️ 合成数据差分校验中..."):
+                # 合成数据用独立的池，不占用生产共享池的名额
+                candidate = make_shared_store_engine(SharedInventoryStore(max_entries=1), 'synthetic') \
+                    if shadow_engine == SHARED_STORE_ENGINE else ALLOCATION_ENGINES[shadow_engine]
+                _, report = run_shadow(*make_synthetic_case(), candidate=candidate)
+            render_shadow_report(report)
+
+    with st.expander("🗄️ 共享库存池"):
+        store = get_inventory_store()
+        store_stats = store.stats()
+        if store_stats: st.dataframe(pd.DataFrame(store_stats), use_container_width=True)
+        else: st.caption("暂无已建池的输入")
+        if st.button("🔄 新导出已到，清空共享库存池", use_container_width=True):
+            store.invalidate()
+            st.success("已清空，下次执行将按新文件重新建池。")
+
+    with st.expander("🕘 运行历史"):
+        # 历史只是附加功能：数据库不可用时给出提示，绝不影响分配主流程
+        try:
+            history = get_run_history()
+            h_day = st.date_input("运行日期 (选填，留空显示最近 50 次)", value=None)
+            runs_df = history.find_runs(date_from=h_day, date_to=h_day)
+            if runs_df.empty: st.caption("该日期暂无运行记录" if h_day else "暂无历史运行记录")
+            else: st.dataframe(runs_df, use_container_width=True, hide_index=True)
+
+            pick = int(st.number_input("运行号", min_value=1, step=1,
+                                       value=int(runs_df['运行号'].iloc[0]) if not runs_df.empty else 1))
+            if st.button("📂 取出该次报告", use_container_width=True):
+                past_report = history.load_report(pick)
+                if past_report:
+                    st.download_button("📥 下载该次报告 (.xlsx)", past_report, f"V36_Result_run{pick}.xlsx", use_container_width=True)
+                else:
+                    st.warning(f"未找到运行号 {pick} 的报告")
+            if st.checkbox("查看该次分配结果"):
+                st.dataframe(history.load_frames(pick).get("分配结果", pd.DataFrame()), use_container_width=True)
+
+            st.markdown("**按 SKU 查询历史分配**")
+            q_sku = st.text_input("SKU")
+            q_col1, q_col2 = st.columns(2)
+            q_fnsku = q_col1.text_input("FNSKU (选填)")
+            q_country = q_col2.text_input("国家 (选填)")
+            q_range = st.date_input("运行日期范围 (选填)", value=[])
+            if q_sku.strip():
+                q_from, q_to = (q_range[0], q_range[-1]) if q_range else (None, None)
+                st.dataframe(history.sku_history(q_sku, fnsku=q_fnsku if q_fnsku.strip() else None, country=q_country.strip(),
+                                                 date_from=q_from, date_to=q_to), use_container_width=True, hide_index=True)
+        except sqlite3.Error as e:
+            st.warning(f"运行历史暂不可用：{e}")
+
     if run_btn:
         col_country_name = mapping['国家']
         country_values = edited_df[col_country_name].fillna('').astype(str).str.strip()
@@ -700,17 +1243,34 @@ with col_side:
             st.error(f"❌ 国家列为必填！第 {', '.join(str(i+1) for i in empty_country_rows)} 行未填写国家，请补全后再执行。")
         elif f_inv and f_po and not edited_df.empty:
             with st.spinner("⚙️ 执行底层去重清洗及智能防爆仓引擎..."):
-                df_inv_raw, err1 = load_and_find_header(f_inv)
-                df_po_raw, err2 = load_and_find_header(f_po)
-                df_plan_raw, _ = load_and_find_header(f_plan)
-
-                if err1: st.error(err1)
-                elif err2: st.error(err2)
+                def load_inputs():
+                    df_inv_raw, err1 = load_and_find_header(f_inv)
+                    df_po_raw, err2 = load_and_find_header(f_po)
+                    df_plan_raw, _ = load_and_find_header(f_plan)
+                    if err1 or err2: raise InputLoadError(err1 or err2)
+                    return df_inv_raw, df_po_raw, df_plan_raw
+
+                try:
+                    store_key = input_fingerprint(f_inv, f_po, f_plan)
+                    # run_allocation 会原地归一化 edited_df，需求指纹必须在运算前取
+                    demand_fp = demand_fingerprint(edited_df)
+                    if shadow_on:
+                        candidate = make_shared_store_engine(get_inventory_store(), store_key) \
+                            if shadow_engine == SHARED_STORE_ENGINE else ALLOCATION_ENGINES[shadow_engine]
+                        (final_df, logs, cleans, order_advice, _), shadow_report = run_shadow(
+                            edited_df, *load_inputs(), mapping, candidate=candidate)
+                    else:
+                        # 同一组文件只在首次执行时解析建池，之后各会话直接领取写时复制的工作副本
+                        with get_inventory_store().checkout(store_key, lambda: InventoryManager(*load_inputs())) as mgr:
+                            final_df, logs, cleans, order_advice = run_allocation(edited_df, mgr, mapping)
+                    run_err = None
+                except InputLoadError as e:
+                    run_err = str(e)
+
+                if run_err: st.error(run_err)
                 else:
-                    mgr = InventoryManager(df_inv_raw, df_po_raw, df_plan_raw)
-                    final_df, logs, cleans, order_advice = run_allocation(edited_df, mgr, mapping)
-
                     st.success("✅ 运算完成！请核对分配结果。")
+                    if shadow_on: render_shadow_report(shadow_report)
 
                     if not order_advice.empty:
                         st.error(f"⚠️ 预警：发现 {len(order_advice)} 个需要真实补单的 SKU！")
@@ -730,13 +1290,15 @@ with col_side:
                     with tab2: st.dataframe(pd.DataFrame(logs), use_container_width=True)
                     with tab3: st.dataframe(pd.DataFrame(cleans), use_container_width=True)
 
-                    buf = io.BytesIO()
-                    with pd.ExcelWriter(buf, engine='xlsxwriter') as writer:
-                        final_df.to_excel(writer, sheet_name='分配结果', index=False)
-                        if not order_advice.empty: order_advice.to_excel(writer, sheet_name='待下单清单(已去重)', index=False)
-                        pd.DataFrame(logs).to_excel(writer, sheet_name='运算日志', index=False)
-                        pd.DataFrame(cleans).to_excel(writer, sheet_name='清洗去重日志', index=False)
+                    report = build_report_xlsx(final_df, logs, cleans, order_advice)
+                    try:
+                        fingerprints = {"库存表": input_fingerprint(f_inv), "采购追踪表": input_fingerprint(f_po),
+                                        "提货计划表": input_fingerprint(f_plan), "需求表": demand_fp}
+                        run_id = get_run_history().save_run(final_df, logs, cleans, order_advice, mapping, fingerprints, report)
+                        st.caption(f"🕘 已存入运行历史（运行号 {run_id}）")
+                    except sqlite3.Error as e:
+                        st.warning(f"运行历史写入失败：{e}")
 
-                    st.download_button("📥 下载完整报告 (.xlsx)", buf.getvalue(), "V36_Result.xlsx", use_container_width=True)
+                    st.download_button("📥 下载完整报告 (.xlsx)", report, "V36_Result.xlsx", use_container_width=True)
         else:
             st.warning("请填写需求数据，并上传库存表和采购追踪表。")